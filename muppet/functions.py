@@ -6,20 +6,39 @@ Common configuration options
 '''
 
 import os
-from os.path import expanduser, islink, isdir
-import sys
+from os.path import expanduser
 import pwd
 import grp
 import stat
-from subprocess import Popen, PIPE, call
+import subprocess
+from subprocess import PIPE
 import logging
 import difflib
 import re
 import shutil
 import errno
-from select import select
+from select import select, poll, POLLIN
+import signal
+import ctypes
 import time
 import socket
+import filecmp
+import threading
+from multiprocessing.pool import ThreadPool
+import hashlib
+import ast
+import glob
+import tempfile
+import functools
+import json
+from collections import OrderedDict
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 WARNLINK = "%s is a link, you'd be on for a lot of confusion - aborting change"
 ROOT = '%s/files/root/%s'
@@ -36,7 +55,155 @@ REID = re.compile(r'''^uid=(?P<uid>\d+)\([^)]+\)[ ]
 REFIREWALL = re.compile(r'''^(?P<toport>\d+)(/(?P<proto>\w+))?[ ]+
                              (?P<action>\w+)[ ]+
                              (?P<fromhost>[\d\.]+(/\d+)?)''', re.VERBOSE)
+REOCTAL = re.compile(r'\\([0-7]{3})')
 STATUS, NOWHERE, RULES = range(3)
+CHROOT = '/usr/sbin/chroot'
+RENDERCACHE = 256
+MESSAGEBUF = 65536
+PIDFDOPEN = 434 # pidfd_open() system call number
+
+# Compiled templates, shared across users configured in parallel
+_templates = {}
+_templateslock = threading.Lock()
+_context = threading.local()
+
+# Modules applied with --only, and the ones they require
+_requiredlock = threading.Lock()
+
+# Rendered templates, least recently used first
+_renders = OrderedDict()
+_renderslock = threading.Lock()
+_renderscache = {}
+
+_metricslock = threading.Lock()
+
+# Packages being downloaded in the background, waited for by one thread
+_prefetchlock = threading.RLock()
+
+# Mountpoints, read once per run
+_mounts = {}
+
+def _count(metric, label='', value=1):
+    '''
+    Add value to run metric
+    '''
+
+    metrics = __muppet__.get('_metrics')
+    if metrics is not None:
+        with _metricslock:
+            metrics[metric, label] = metrics.get((metric, label), 0) + value
+
+def _resource(function):
+    '''
+    Count resources checked and changed by function
+    '''
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        # Resources in modules left out with --only don't get checked
+        if not _isselected():
+            return False
+
+        change = function(*args, **kwargs)
+        _count('checked', function.__name__)
+        if change:
+            _count('changed', function.__name__)
+        return change
+
+    return wrapper
+
+class Popen(subprocess.Popen):
+    '''
+    Run subprocess, counting it
+    '''
+
+    def __init__(self, *args, **kwargs):
+        _count('subprocesses')
+
+        # Messages still queued for the terminal go before whatever the
+        # subprocess writes there itself
+        if kwargs.get('stdout') is None or kwargs.get('stderr') is None:
+            for handler in logging.getLogger().handlers:
+                handler.flush()
+
+        subprocess.Popen.__init__(self, *args, **kwargs)
+
+def call(*args, **kwargs):
+    '''
+    Run subprocess and return its exit status, counting it
+    '''
+
+    return Popen(*args, **kwargs).wait()
+
+def _expand(path):
+    '''
+    Expand user home directory, as seen from the alternate root
+    '''
+
+    if __muppet__.get('_root') and path.startswith('~'):
+        user, sep, rest = path[1:].partition('/')
+        return _dbentry('/etc/passwd', user or 'root')[5] + sep + rest
+    else:
+        return expanduser(path)
+
+def _path(path):
+    '''
+    Return path under alternate root
+    '''
+
+    return __muppet__.get('_root', '') + _expand(path)
+
+def _chroot(*cmd):
+    '''
+    Return command to run under alternate root
+    '''
+
+    if __muppet__.get('_root'):
+        return [CHROOT, __muppet__['_root']] + list(cmd)
+    else:
+        return list(cmd)
+
+def _dpkg(*args):
+    '''
+    Return dpkg command to run against alternate root
+    '''
+
+    if __muppet__.get('_root'):
+        return ['/usr/bin/dpkg', '--root=%s' % __muppet__['_root']] + list(args)
+    else:
+        return ['/usr/bin/dpkg'] + list(args)
+
+def _dbentry(database, name):
+    '''
+    Return entry from passwd-like database under alternate root
+    '''
+
+    with open(_path(database)) as fhl:
+        for line in fhl:
+            entry = line.rstrip('\n').split(':')
+            if entry[0] == name:
+                return entry
+    raise KeyError("%s not found in %s" % (name, _path(database)))
+
+def _uid(owner):
+    '''
+    Return UID of owner under alternate root
+    '''
+
+    if __muppet__.get('_root'):
+        return int(_dbentry('/etc/passwd', owner)[2])
+    else:
+        return pwd.getpwnam(owner).pw_uid
+
+def _gid(group):
+    '''
+    Return GID of group under alternate root
+    '''
+
+    if __muppet__.get('_root'):
+        return int(_dbentry('/etc/group', group)[2])
+    else:
+        return grp.getgrnam(group).gr_gid
 
 def resource(res):
     '''
@@ -57,19 +224,226 @@ def users():
         logging.warning("invalid user:group specification - ignoring")
         return []
 
-def include(module):
+def _isselected():
+    '''
+    Return whether resources in the module this thread executes are applied
+    '''
+
+    return getattr(_context, 'selected', __muppet__.get('_selected', True))
+
+def _selecting(selected, function, *args):
+    '''
+    Call function, applying resources in this thread only if selected
+    '''
+
+    parent = _context.__dict__.get('selected')
+    _context.selected = selected
+    try:
+        return function(*args)
+    finally:
+        if parent is None:
+            del _context.selected
+        else:
+            _context.selected = parent
+
+def _select(module, tags):
+    '''
+    Return whether resources in module should be applied, or None if it
+    should be skipped altogether
+    '''
+
+    names = set([module]) | set(tags)
+    if names & __muppet__.get('_skip', set()):
+        logging.debug("skipping %s", module)
+        return None
+    else:
+        return _isselected() or \
+            bool(names & __muppet__.get('_only', set()))
+
+def _requirements():
+    '''
+    Return modules each module requires, as declared to include() anywhere
+    in manifests, and find modules applied with foreachuser()
+    '''
+
+    requirements = __muppet__.get('_requires')
+    if requirements is None:
+        requirements = __muppet__['_requires'] = {}
+        __muppet__['_peruser'] = set(
+            node.args[0].s for node in _manifestcalls('foreachuser')
+            if node.args and isinstance(node.args[0], ast.Str))
+        for node in _manifestcalls('include'):
+            args = node.args + [None] * (3 - len(node.args))
+            for keyword in node.keywords:
+                if keyword.arg == 'requires':
+                    args[2] = keyword.value
+            if isinstance(args[0], ast.Str) and \
+               isinstance(args[2], (ast.List, ast.Tuple)):
+                declared = requirements.setdefault(args[0].s, [])
+                declared += [elt.s for elt in args[2].elts
+                             if isinstance(elt, ast.Str) and \
+                                 elt.s not in declared]
+
+    return requirements
+
+def _declare(module, requires=(), peruser=False):
+    '''
+    Add modules module requires, or that it's applied with foreachuser(),
+    to what manifests declare
+    '''
+
+    with _requiredlock:
+        declared = _requirements().setdefault(module, [])
+        declared += [requirement for requirement in requires
+                     if requirement not in declared]
+        if peruser:
+            __muppet__['_peruser'].add(module)
+
+def _require(module):
+    '''
+    Apply modules module requires and the ones they require, unless module
+    was already applied during this run
+    '''
+
+    with _requiredlock:
+        declared = list(_requirements().get(module, ()))
+        peruser = set(__muppet__['_peruser'])
+        required = __muppet__.setdefault('_required', set())
+        if module in required:
+            return False
+        required.add(module)
+
+    for requirement in declared:
+        if _select(requirement, ()) is not None and _require(requirement):
+            logging.debug("applying %s, which %s requires",
+                          requirement, module)
+            # Modules written for foreachuser() need a user and group
+            if requirement in peruser:
+                _selecting(True, foreachuser, requirement)
+            else:
+                _selecting(True, _execute, requirement)
+
+    return True
+
+def _execute(module):
     '''
     Execute module with common globals
     '''
 
-    execfile('%s/manifests/%s.py' % \
-        (__muppet__['_directory'], module), __muppet__.copy())
+    execfile('%s/manifests/%s.py' % (__muppet__['_directory'], module),
+             __muppet__.copy())
 
+def include(module, tags=(), requires=()):
+    '''
+    Execute module with common globals
+    '''
+
+    selected = _select(module, tags)
+    if selected is None:
+        return
+
+    # With --only, apply modules selected ones require first, and each of
+    # them once
+    if __muppet__.get('_only'):
+        _declare(module, requires)
+        if selected and not _require(module):
+            return
+
+    _selecting(selected, _execute, module)
+
+class _UserFilter(logging.Filter):
+    '''
+    Prefix messages with the user they're about
+    '''
+
+    def filter(self, record):
+        user = getattr(_context, 'user', None)
+        if user:
+            record.msg = '%s: %s' % (user, record.getMessage())
+            record.args = ()
+        return True
+
+def _foruser(code, user, group, selected):
+    '''
+    Execute compiled module for user
+    '''
+
+    _context.user = user
+    _context.selected = selected
+    try:
+        scope = __muppet__.copy()
+        scope['user'], scope['group'] = user, group
+        exec code in scope # pylint: disable=exec-used
+        return None
+    except SystemExit, exc:
+        logging.warning("Exited: %s", exc)
+        return None
+    except Exception, exc: # pylint: disable=broad-except
+        logging.exception(exc)
+        return exc
+    finally:
+        _context.user = None
+        del _context.selected
+
+def foreachuser(module, jobs=None, tags=()):
+    '''
+    Execute module for each user in parallel
+    '''
+
+    selected = _select(module, tags)
+    if selected is None:
+        return []
+    if __muppet__.get('_only'):
+        _declare(module, peruser=True)
+        if selected:
+            _require(module)
+
+    path = '%s/manifests/%s.py' % (__muppet__['_directory'], module)
+    with open(path) as fhl:
+        code = compile(fhl.read(), path, 'exec')
+
+    pairs = users()
+    if not pairs:
+        return []
+    logging.info("configuring %d users with %s", len(pairs), module)
+
+    userfilter = _UserFilter()
+    logging.getLogger().addFilter(userfilter)
+    pool = ThreadPool(min(jobs or __muppet__.get('_jobs', 1), len(pairs)))
+    try:
+        results = [(user, pool.apply_async(_foruser,
+                                           (code, user, group, selected)))
+                   for user, group in pairs]
+        failed = []
+        for i, (user, result) in enumerate(results, 1):
+            error = result.get()
+            if error:
+                failed.append(user)
+                logging.warning("%s failed (%d/%d): %s",
+                                user, i, len(results), error)
+            else:
+                logging.debug("%s done (%d/%d)", user, i, len(results))
+    finally:
+        pool.close()
+        pool.join()
+        logging.getLogger().removeFilter(userfilter)
+
+    if failed:
+        logging.warning("%d of %d users failed: %s",
+                        len(failed), len(pairs), ', '.join(failed))
+    return failed
+
+@_resource
 def firewall(action=None, fromhost=None, toport=None, proto=None):
     '''
     Set up firewall
     '''
 
+    # ufw would set up the firewall of the running system, even chrooted
+    if __muppet__.get('_root'):
+        logging.warning("won't set up firewall in alternate root")
+        return False
+
     # Check firewall status
     proc = Popen(['ufw', 'status'], stdout=PIPE, stderr=PIPE)
     out, err = proc.communicate()
@@ -99,12 +473,14 @@ def firewall(action=None, fromhost=None, toport=None, proto=None):
         return False
 
     # Enable firewall if needs be
+    change = False
     if status != 'active':
         cmd = ['ufw', 'enable']
         logging.info(' '.join(cmd))
         if not __muppet__['_dryrun']:
             proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
             _messages(proc)
+        change = True
 
     # Change firewall settings if needs be
     rule = action, proto, fromhost, toport
@@ -117,12 +493,21 @@ def firewall(action=None, fromhost=None, toport=None, proto=None):
         if not __muppet__['_dryrun']:
             proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
             _messages(proc)
+        change = True
 
+    return change
+
+@_resource
 def addprinter(name, uri, ppd):
     '''
     Add printer
     '''
 
+    # lpadmin would add printer to the running CUPS server, even chrooted
+    if __muppet__.get('_root'):
+        logging.warning("won't add printer %s in alternate root", name)
+        return False
+
     with open(os.devnull, 'w') as devnull:
         args = ['/usr/bin/lpstat', '-p', name]
         if call(args, stdout=devnull, stderr=devnull) != 0:
@@ -132,7 +517,9 @@ def addprinter(name, uri, ppd):
                     '-v', uri,
                     '-P' if os.path.exists(ppd) else '-m', ppd,
                     '-E')
+            return True
 
+    return False
 
 def resolution():
     '''
@@ -173,35 +560,51 @@ def _messages(proc):
     Log messages
     '''
 
-    while True:
-        # Has the child exited yet?
-        returncode = proc.poll()
-        if returncode != None:
-            return returncode
-
-        # Check if there's data ready
-        readies = select([proc.stdout.fileno(), proc.stderr.fileno()], [], [])
-
-        # Write data
-        for ready in readies[0]:
-            if ready == proc.stdout.fileno():
-                # Split lines with '\r' to take only the last chunk as these
-                # lines are assumed to be used to show progress and we only
-                # need the result
-                line = proc.stdout.readline().rstrip().split('\r')[-1]
-                if line:
-                    logging.debug(line)
-
-                    # Add carriage return that's missing with e.g. apt-get,
-                    # then flush
-                    print '\r',
-                    sys.stdout.flush()
-            elif ready == proc.stderr.fileno():
-                line = proc.stderr.readline().rstrip().split('\r')[-1]
-                if line:
-                    logging.warning(line)
-                    print >> sys.stderr, '\r',
-                    sys.stderr.flush()
+    # Subprocess output is only logged with --verbose, so don't bother
+    # splitting it otherwise
+    verbose = logging.getLogger().isEnabledFor(logging.DEBUG)
+    stdout = proc.stdout.fileno()
+    pending = {stdout: '', proc.stderr.fileno(): ''}
+
+    while pending:
+        # Keep on reading what's left once the child has exited, but don't
+        # wait for pipes held open by processes it left behind
+        exited = proc.poll() is not None
+        readies = select(pending.keys(), [], [], 0 if exited else 1)[0]
+        if exited and not readies:
+            break
+
+        for ready in readies:
+            data = os.read(ready, MESSAGEBUF)
+            if data:
+                lines = (pending[ready] + data).split('\n')
+                pending[ready] = lines.pop()
+            else:
+                lines = [pending.pop(ready)]
+            _message(ready == stdout, lines, verbose)
+
+    for ready, rest in pending.items():
+        _message(ready == stdout, [rest], verbose)
+
+    return proc.wait()
+
+def _message(isstdout, lines, verbose):
+    '''
+    Log lines of subprocess output
+    '''
+
+    # Split lines with '\r' to take only the last chunk as these lines are
+    # assumed to be used to show progress and we only need the result
+    lines = [line.rstrip().split('\r')[-1] for line in lines]
+    lines = [line for line in lines if line]
+    if not lines or isstdout and not verbose:
+        return
+
+    for line in lines:
+        if isstdout:
+            logging.debug(line)
+        else:
+            logging.warning(line)
 
 def _logrun(*cmd):
     '''
@@ -220,88 +623,199 @@ def _comm(*cmd):
 
     return Popen(cmd, stdout=PIPE, stderr=PIPE).communicate()
 
-def run(command):
+def _shell(command, **kwargs):
+    '''
+    Start shell command, in alternate root if need be
+    '''
+
+    if __muppet__.get('_root'):
+        return Popen(_chroot('/bin/sh', '-c', command), **kwargs)
+    else:
+        return Popen(command, shell=True, **kwargs)
+
+def _succeeds(command):
     '''
-    Run command
+    Return whether guard command exits successfully, quietly
     '''
 
+    proc = _shell(command, stdout=PIPE, stderr=PIPE)
+    proc.communicate()
+    return proc.returncode == 0
+
+def _watchdigest(paths):
+    '''
+    Return digest of watched files and trees
+    '''
+
+    digest = hashlib.sha1()
+    for path in paths:
+        path = _path(path)
+        if os.path.isdir(path):
+            filepaths = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                filepaths += ['%s/%s' % (dirpath, filename)
+                              for filename in sorted(filenames)]
+        else:
+            filepaths = [path]
+
+        for filepath in filepaths:
+            digest.update(filepath + '\0')
+            try:
+                with open(filepath) as fhl:
+                    for chunk in iter(lambda: fhl.read(65536), ''):
+                        digest.update(chunk)
+            except IOError, exc:
+                digest.update(os.strerror(exc.errno))
+            digest.update('\0')
+
+    return digest.hexdigest()
+
+@_resource
+def run(command, creates=None, unless=None, onlyif=None, watch=()):
+    '''
+    Run command unless guards say otherwise or watched files didn't change
+    '''
+
+    if creates and os.path.lexists(_path(creates)):
+        return False
+    if unless and _succeeds(unless):
+        return False
+    if onlyif and not _succeeds(onlyif):
+        return False
+
+    # Only run again once watched files changed since the last success
+    if isinstance(watch, basestring):
+        watch = [watch]
+    if watch:
+        key = hashlib.sha1('%s\0%s' % (__muppet__.get('_root') or '',
+                                        command)).hexdigest()
+        stamp = '%s/cache/run/%s' % (__muppet__['_directory'], key)
+        inputs = _watchdigest(watch)
+        try:
+            with open(stamp) as fhl:
+                if fhl.read() == inputs:
+                    logging.debug("%s: inputs unchanged, not running", command)
+                    return False
+        except IOError:
+            pass
+
     if not __muppet__['_dryrun']:
-        proc = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
-        _messages(proc)
+        proc = _shell(command, stdout=PIPE, stderr=PIPE)
+        if _messages(proc) == 0 and watch:
+            try:
+                if not os.path.isdir(os.path.dirname(stamp)):
+                    os.makedirs(os.path.dirname(stamp))
+                tmppath = '%s.%d.%s' % (stamp, os.getpid(),
+                                        threading.current_thread().ident)
+                with open(tmppath, 'w') as fhl:
+                    fhl.write(inputs)
+                os.rename(tmppath, stamp)
+            except (IOError, OSError), exc:
+                logging.warning(exc)
+
+    return True
 
 def _service(service, action, status):
     '''
     Manage services with init, Upstart and systemd
     '''
 
-    if os.path.exists('/bin/systemctl'): # If it's systemd
+    # Services can be enabled or disabled in an alternate root, but there's
+    # nothing running there to start or stop
+    root = __muppet__.get('_root')
+    change = False
+
+    if os.path.exists(_path('/bin/systemctl')): # If it's systemd
+        systemctl = ['/bin/systemctl'] + (['--root=%s' % root] if root else [])
+
         # Enable/disable service if needs be
-        isenabled = _comm('/bin/systemctl', 'is-enabled', service)[0].strip()
+        isenabled = _comm(*systemctl + ['is-enabled', service])[0].strip()
         if isenabled not in ('enabled', 'disabled'):
             logging.warn("%s is %s, won't enable or disable",
                          service, isenabled)
         elif action not in isenabled: # E.g. 'enable' not in 'disabled'
-            _logrun('/bin/systemctl', action, service)
+            _logrun(*systemctl + [action, service])
+            change = True
 
         # Start/stop service if needs be
+        if root:
+            return change
         isactive = _comm('/bin/systemctl', 'is-active', service)[0].strip()
         if isactive not in ('active', 'inactive'):
             logging.warn("%s is %s, won't start or stop", service, isactive)
         if action == 'enable' and isactive == 'inactive':
             _logrun('/bin/systemctl', 'start', service)
+            change = True
         elif action == 'disable' and isenabled == 'active':
             _logrun('/bin/systemctl', 'stop', service)
-    elif os.path.exists('/etc/init/%s.conf' % service): # If it's Upstart
+            change = True
+    elif os.path.exists(_path('/etc/init/%s.conf' % service)): # If it's Upstart
         # Enable/disable service if needs be
-        path = '/etc/init/%s.override' % service
+        path = _path('/etc/init/%s.override' % service)
         if action == 'enable' and os.path.exists(path):
             logging.info("removing %s", path)
             if not __muppet__['_dryrun']:
                 os.remove(path)
+            change = True
         elif action == 'disable' and not os.path.exists(path):
             logging.info("adding %s", path)
             if not __muppet__['_dryrun']:
                 fhl = open(path, 'w')
                 fhl.write('manual')
                 fhl.close()
+            change = True
 
         # Start/stop service if needs be
+        if root:
+            return change
         isactive, _ = _comm('/sbin/status', service)
         if 'start' not in isactive and 'stop' not in isactive:
             logging.warn("%s is %s, won't start or stop", service, isactive)
         if action == 'enable' and 'stop' in isactive:
             _logrun('/sbin/start', service)
+            change = True
         elif action == 'disable' and 'start' in isactive:
             _logrun('/sbin/stop', service)
+            change = True
     else: # If it's init, which still does happen with Raring
         # Enable/disable service if needs be
-        for filename in os.listdir('/etc/rc2.d'):
+        for filename in os.listdir(_path('/etc/rc2.d')):
             if service == filename[3:]:
                 isenabled = 'enabled' if filename[0] == 'S' else 'disabled'
                 if action not in isenabled: # E.g. 'enable' not in 'disabled'
-                    _logrun('/usr/sbin/update-rc.d', service, action)
+                    _logrun(*_chroot('/usr/sbin/update-rc.d', service, action))
+                    change = True
 
         # Start/stop service if needs be
+        if root:
+            return change
         isactive, _ = _comm('/usr/sbin/service', service, 'status')
         if status and status in isactive:
             if action == 'enable':
                 _logrun('/usr/sbin/service', service, 'start')
+                change = True
             elif action == 'disable':
                 _logrun('/usr/sbin/service', service, 'stop')
+                change = True
 
+    return change
+
+@_resource
 def enable(service, status=None):
     '''
     Enable and turn on service
     '''
 
-    _service(service, 'enable', status)
+    return _service(service, 'enable', status)
 
+@_resource
 def disable(service, status=None):
     '''
     Disable and turn off service
     '''
 
-    _service(service, 'disable', status)
+    return _service(service, 'disable', status)
 
 def _getmaintainer(maintainer):
     '''
@@ -310,6 +824,8 @@ def _getmaintainer(maintainer):
 
     cmd = ['dpkg-query', '--show', '--showformat',
            '${Package} ${Maintainer}\\n']
+    if __muppet__.get('_root'):
+        cmd.append('--admindir=%s' % _path('/var/lib/dpkg'))
     proc = Popen(cmd, stdout=PIPE)
     maintained = set()
     for line in proc.stdout:
@@ -327,7 +843,7 @@ def getselections():
     # Get set of already-installed packages
     # ubuntu list packages which are installed
     # -> http://askubuntu.com/questions/17823/how-to-list-all-installed-packages
-    proc = Popen(['/usr/bin/dpkg', '--get-selections'], stdout=PIPE)
+    proc = Popen(_dpkg('--get-selections'), stdout=PIPE)
     installed = set()
     for line in proc.stdout:
         # Get rid of possible ':amd64'-like suffixes
@@ -336,17 +852,108 @@ def getselections():
 
     return installed
 
+def _aptcmd(command, args, dryrun):
+    '''
+    Return apt-get command line
+    '''
+
+    return "DEBIAN_FRONTEND=noninteractive %s -qy %s%s %s" % \
+        (' '.join(_chroot('/usr/bin/apt-get')), '-s ' if dryrun else '',
+         command, ' '.join(args))
+
+def _waitprefetch():
+    '''
+    Wait for packages being downloaded in the background
+    '''
+
+    # Other threads wait for the download to end too, but only one reports
+    # how it went
+    with _prefetchlock:
+        prefetching = __muppet__.get('_prefetch')
+        if prefetching:
+            proc, errfile = prefetching
+            if proc.poll() is None:
+                logging.info("waiting for packages to download")
+                proc.wait()
+            errfile.seek(0)
+            for line in errfile:
+                logging.warning(line.rstrip())
+            errfile.close()
+            __muppet__['_prefetch'] = None
+
 def _aptget(command, args, dryrun):
     '''
     Run apt-get
     '''
 
-    cmd = "DEBIAN_FRONTEND=noninteractive /usr/bin/apt-get -qy %s%s %s" % \
-        ('-s ' if dryrun else '', command, ' '.join(args))
+    # apt-get would fail to lock the archive cache
+    _waitprefetch()
+
+    cmd = _aptcmd(command, args, dryrun)
     logging.info(cmd)
+    begin = time.time()
     proc = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
     _messages(proc)
+    _count('aptseconds', value=time.time() - begin)
 
+def _manifestcalls(function):
+    '''
+    Return calls to function in manifests
+    '''
+
+    calls = []
+    for path in sorted(glob.glob('%s/manifests/*.py' %
+                                 __muppet__['_directory'])):
+        try:
+            with open(path) as fhl:
+                tree = ast.parse(fhl.read(), path)
+        except SyntaxError, exc:
+            logging.warning(exc)
+            continue
+        calls += [node for node in ast.walk(tree)
+                  if isinstance(node, ast.Call) and \
+                      isinstance(node.func, ast.Name) and \
+                      node.func.id == function]
+
+    return calls
+
+def _manifestpackages():
+    '''
+    Return packages install() is called with in manifests
+    '''
+
+    packages = set()
+    for node in _manifestcalls('install'):
+        packages.update(arg.s for arg in node.args
+                        if isinstance(arg, ast.Str))
+
+    return packages
+
+def prefetch(*args):
+    '''
+    Download packages in the background
+    '''
+
+    # Packages of all manifests aren't needed for a run with --only
+    if __muppet__['_dryrun'] or not _isselected():
+        return False
+
+    # Download packages if needs be
+    todownload = set(args or _manifestpackages()) - getselections()
+    if todownload:
+        with _prefetchlock:
+            _waitprefetch()
+            cmd = _aptcmd('install --download-only', todownload, False)
+            logging.info("%s &", cmd)
+            errfile = tempfile.TemporaryFile()
+            with open(os.devnull, 'w') as devnull:
+                proc = Popen(cmd, shell=True, stdout=devnull, stderr=errfile)
+            __muppet__['_prefetch'] = proc, errfile
+        return True
+
+    return False
+
+@_resource
 def install(*args):
     '''
     Run apt-get install
@@ -356,7 +963,9 @@ def install(*args):
     toinstall = set(args) - getselections()
     if toinstall:
         _aptget('install', toinstall, __muppet__['_dryrun'])
+        return True
 
+@_resource
 def purge(*args, **maintainer):
     '''
     Run apt-get purge
@@ -369,7 +978,9 @@ def purge(*args, **maintainer):
 
     if topurge:
         _aptget('purge', topurge, __muppet__['_dryrun'])
+        return True
 
+@_resource
 def aptkey(keyfile):
     '''
     Run apt-key add
@@ -386,7 +997,7 @@ def aptkey(keyfile):
             # Don't break lest gpg may not end
 
     # Do we already have a key with this fingerprint?
-    cmd = ['/usr/bin/apt-key', 'fingerprint']
+    cmd = _chroot('/usr/bin/apt-key', 'fingerprint')
     proc = Popen(cmd, stdout=PIPE, stderr=devnull)
     exists = False
     for line in proc.stdout:
@@ -396,20 +1007,28 @@ def aptkey(keyfile):
 
     # Add key if needs be
     if not exists:
-        cmd = ['/usr/bin/apt-key', 'add', keyfile]
-        logging.info(' '.join(cmd))
+        if __muppet__.get('_root'):
+            # The key file isn't visible from the alternate root
+            cmd = _chroot('/usr/bin/apt-key', 'add', '-')
+            logging.info("%s < %s", ' '.join(cmd), keyfile)
+        else:
+            cmd = ['/usr/bin/apt-key', 'add', keyfile]
+            logging.info(' '.join(cmd))
         if not __muppet__['_dryrun']:
-            proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-            _messages(proc)
+            with open(keyfile) as fhl:
+                proc = Popen(cmd, stdin=fhl, stdout=PIPE, stderr=PIPE)
+                _messages(proc)
 
     devnull.close()
+    return not exists
 
+@_resource
 def addmuppetrepo():
     '''
     Add muppet repository
     '''
 
-    path = '/etc/apt/sources.list.d/muppet.list'
+    path = _path('/etc/apt/sources.list.d/muppet.list')
     if os.path.exists(path):
         return False
     else:
@@ -421,15 +1040,21 @@ def addmuppetrepo():
 
         return True
 
+@_resource
 def adduser(user, password, shell):
     '''
     Add user
     '''
 
-    # TODO Check if user is already there
+    # Is this user already there?
+    try:
+        _uid(user)
+        return False
+    except KeyError:
+        pass
 
     # Create user without password, preventing him from logging in
-    cmd = ['/usr/sbin/useradd', '-m', user, '-s', shell]
+    cmd = _chroot('/usr/sbin/useradd', '-m', user, '-s', shell)
     logging.info(' '.join(cmd))
     if not __muppet__['_dryrun']:
         proc = Popen(cmd, stderr=PIPE)
@@ -438,7 +1063,7 @@ def adduser(user, password, shell):
             logging.warning(line)
 
     # Set encrypted password, allowing him to log in
-    cmd = ['/usr/sbin/chpasswd', '-e']
+    cmd = _chroot('/usr/sbin/chpasswd', '-e')
     logging.info(' '.join(cmd))
     if not __muppet__['_dryrun'] and proc.returncode == 0:
         proc = Popen(cmd, stdin=PIPE, stderr=PIPE)
@@ -446,13 +1071,16 @@ def adduser(user, password, shell):
         for line in err.splitlines():
             logging.warning(line)
 
+    return True
+
+@_resource
 def addgroup(group, gid=None):
     '''
     Add group
     '''
 
     # Does this group already exist?
-    groups = open('/etc/group')
+    groups = open(_path('/etc/group'))
     for line in groups:
         knowngroup, _, knowngid, _ = line.split(':', 3)
         if group == knowngroup:
@@ -463,7 +1091,7 @@ def addgroup(group, gid=None):
     groups.close()
 
     # Add group
-    cmd = ['/usr/sbin/groupadd']
+    cmd = _chroot('/usr/sbin/groupadd')
     if gid:
         cmd.extend(['-g', str(gid)])
     cmd.append(group)
@@ -471,14 +1099,116 @@ def addgroup(group, gid=None):
     if not __muppet__['_dryrun']:
         proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
         _messages(proc)
+    return True
+
+def _sessionpids(sid):
+    '''
+    Return processes in session
+    '''
+
+    pids = []
+    for name in os.listdir('/proc'):
+        if name.isdigit() and int(name) != os.getpid():
+            try:
+                with open('/proc/%s/stat' % name) as fhl:
+                    # The command name may have spaces and parentheses
+                    fields = fhl.read().rsplit(')', 1)[1].split()
+            except (IOError, IndexError): # Process may have just exited
+                continue
+            if int(fields[3]) == sid and fields[0] != 'Z': # Not a zombie
+                pids.append(int(name))
+
+    return pids
+
+def _pidfd(pid):
+    '''
+    Return file descriptor to wait for process, if supported
+    '''
+
+    try:
+        if hasattr(os, 'pidfd_open'):
+            return os.pidfd_open(pid)
+        else:
+            libc = ctypes.CDLL(None, use_errno=True)
+            pidfd = libc.syscall(PIDFDOPEN, pid, 0)
+            return pidfd if pidfd >= 0 else None
+    except (AttributeError, OSError):
+        return None
+
+def _waitpids(pids, timeout):
+    '''
+    Wait for processes to exit, return whether they did in time
+    '''
+
+    deadline = time.time() + timeout
+
+    # Wait on pidfds where available, check for the others every so often
+    pidfds = []
+    polled = []
+    for pid in pids:
+        pidfd = _pidfd(pid)
+        if pidfd is None:
+            polled.append(pid)
+        else:
+            pidfds.append(pidfd)
+    poller = poll()
+    for pidfd in pidfds:
+        poller.register(pidfd, POLLIN)
+
+    try:
+        while pidfds or polled:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            wait = min(remaining, .1) if polled else remaining
+            for pidfd, _ in poller.poll(wait * 1000):
+                poller.unregister(pidfd)
+                os.close(pidfd)
+                pidfds.remove(pidfd)
+            polled = [pid for pid in polled if os.path.exists('/proc/%d' % pid)]
 
-def usermod(login, uid=None, group='', groups=[]):
+        return True
+    finally:
+        for pidfd in pidfds:
+            os.close(pidfd)
+
+def _killsession(sid, timeout):
+    '''
+    Terminate processes in session, then kill those left after timeout
+    '''
+
+    for signum in signal.SIGTERM, signal.SIGKILL:
+        deadline = time.time() + timeout
+
+        # Processes may spawn others while they're being waited on
+        pids = _sessionpids(sid)
+        while pids and time.time() < deadline:
+            for pid in pids:
+                try:
+                    os.kill(pid, signum)
+                except OSError, exc:
+                    if exc.errno != errno.ESRCH:
+                        raise
+            _waitpids(pids, deadline - time.time())
+            pids = _sessionpids(sid)
+
+        if not pids:
+            return True
+        elif signum == signal.SIGTERM:
+            logging.warning("session %d still has %d processes after %ds - "
+                            "killing them", sid, len(pids), timeout)
+
+    return False
+
+@_resource
+def usermod(login, uid=None, group='', groups=[], timeout=30):
     '''
     Modify user account
     '''
 
     # Check user and groups
-    proc = Popen(['id', login], stdout=PIPE)
+    proc = Popen(_chroot('id', login), stdout=PIPE)
     match = REID.match(proc.stdout.next())
     curuid = int(match.group('uid'))
     curgid = match.group('group')
@@ -492,64 +1222,179 @@ def usermod(login, uid=None, group='', groups=[]):
     groups = ['-a', '-G', ','.join(groupstoadd)] if groupstoadd else []
 
     if uid or group or groups:
-        cmd = ['/usr/sbin/usermod'] + uid + group + groups + [login]
+        cmd = _chroot('/usr/sbin/usermod', *uid + group + groups + [login])
         logging.info(' '.join(cmd))
         if not __muppet__['_dryrun']:
             # Kill session, because the user to mod probably has processes there
-            if uid:
+            # - unless it's in an alternate root, where nothing runs
+            if uid and not __muppet__.get('_root'):
                 if not __muppet__['_sid']:
                     logging.warning("won't run usermod without daemonising")
                     return
-                call(['/usr/bin/pkill', '-s', str(__muppet__['_sid'])])
-                while call(['/usr/bin/pgrep', '-s0']) == 0:
-                    time.sleep(5)
+                if not _killsession(__muppet__['_sid'], timeout):
+                    logging.warning("session %d won't end - aborting usermod",
+                                    __muppet__['_sid'])
+                    return False
 
             # Run usermod
             proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
             _messages(proc)
+        return True
+
+def _ismount(path):
+    '''
+    Check if path is a mountpoint
+    '''
+
+    if 'points' not in _mounts:
+        try:
+            with open('/proc/self/mountinfo') as fhl:
+                _mounts['points'] = set(
+                    REOCTAL.sub(lambda match: chr(int(match.group(1), 8)),
+                                line.split()[4])
+                    for line in fhl)
+        except IOError:
+            _mounts['points'] = None
+
+    if _mounts['points'] is None:
+        return os.path.ismount(path)
+
+    # Mountpoints are listed with their canonical path, which a path through
+    # a linked parent directory isn't
+    path = os.path.normpath(path)
+    return os.path.join(os.path.realpath(os.path.dirname(path)),
+                        os.path.basename(path)) in _mounts['points']
+
+class _Snapshot(object):
+    '''
+    Status of path, taken once with lstat and reused for all checks
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._status = None
+        try:
+            self.lstatus = os.lstat(path)
+        except OSError, exc:
+            if exc.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            self.lstatus = None
+
+    @property
+    def exists(self):
+        '''
+        Check if path exists, be it a dangling link
+        '''
+
+        return self.lstatus is not None
+
+    @property
+    def islink(self):
+        '''
+        Check if path is a link
+        '''
+
+        return self.exists and stat.S_ISLNK(self.lstatus.st_mode)
+
+    @property
+    def status(self):
+        '''
+        Return status of path, following links
+        '''
+
+        if self._status is None:
+            if self.exists and not self.islink:
+                self._status = self.lstatus
+            else:
+                self._status = os.stat(self.path)
+        return self._status
+
+    @property
+    def isdir(self):
+        '''
+        Check if path is a directory, following links
+        '''
+
+        try:
+            return stat.S_ISDIR(self.status.st_mode)
+        except OSError:
+            return False
+
+    @property
+    def ismount(self):
+        '''
+        Check if path is a mountpoint
+        '''
+
+        return _ismount(self.path)
 
-def _chown(path, status, owner, group, link=False):
+def _chown(snapshot, owner, group, link=False):
     '''
     Change owner
     '''
 
-    uid = pwd.getpwnam(owner).pw_uid
-    gid = grp.getgrnam(group).gr_gid
-    if os.path.ismount(expanduser(path)):
+    path = snapshot.path
+    status = snapshot.lstatus if link else snapshot.status
+    uid = _uid(owner)
+    gid = _gid(group)
+    if snapshot.ismount:
         logging.warn("%s is a mountpoint - won't chown", path)
     elif uid != status.st_uid or gid != status.st_gid:
         logging.info("chowning %s:%s %s", owner, group, path)
         if not __muppet__['_dryrun']:
             if link:
-                os.lchown(expanduser(path), uid, gid)
+                os.lchown(path, uid, gid)
             else:
-                os.chown(expanduser(path), uid, gid)
+                os.chown(path, uid, gid)
         return True
     return False
 
+@_resource
 def chmod(path, modestr):
     '''
     Change mode
     '''
 
     try:
-        status = os.stat(expanduser(path))
+        return _chmod(_Snapshot(_path(path)), modestr)
+    except OSError, exc:
+        logging.warning(exc)
+        return False
 
-        # Translate a human-readable mode into a machine-readable one
-        if len(modestr) != 10:
+def _mode(modestr):
+    '''
+    Translate a human-readable mode into a machine-readable one
+    '''
+
+    if len(modestr) != 10:
+        return None
+    mode = 0
+    for i, char in enumerate(modestr[1:]):
+        if char != '-':
+            mode |= MODES[i]
+
+    return mode
+
+def _chmod(snapshot, modestr):
+    '''
+    Change mode of path under alternate root
+    '''
+
+    path = snapshot.path
+    try:
+        status = snapshot.status
+
+        mode = _mode(modestr)
+        if mode is None:
             logging.warning("invalid %s mode - aborting chmod", modestr)
             return False
-        mode = 0
-        for i, char in enumerate(modestr[1:]):
-            if char != '-':
-                mode |= MODES[i]
 
-        if os.path.ismount(expanduser(path)):
+        if snapshot.ismount:
             logging.warn("%s is a mountpoint - won't chmod", path)
         elif mode != stat.S_IMODE(status.st_mode):
             logging.info("chmoding %s %s", oct(mode), path)
             if not __muppet__['_dryrun']:
-                os.chmod(expanduser(path), mode)
+                os.chmod(path, mode)
             return True
     except OSError, exc:
         logging.warning(exc)
@@ -562,7 +1407,7 @@ def _diff(path, contents):
     '''
 
     try:
-        configfile = open(expanduser(path))
+        configfile = open(path)
         diff = list(difflib.unified_diff(configfile.read().splitlines(True),
                                          contents.splitlines(True),
                                          path, '<new>'))
@@ -580,32 +1425,147 @@ def _template(path, variables):
     '''
     from mako.template import Template
 
-    identifiers = (k for k in __muppet__.keys() if k[0] != '_')
-    tpt = Template(
-        filename=path,
-        input_encoding='utf-8',
-        imports=[IMPORT % ', '.join(identifiers)],
-    )
+    with _templateslock:
+        if path not in _templates:
+            identifiers = (k for k in __muppet__.keys() if k[0] != '_')
+            _templates[path] = Template(
+                filename=path,
+                input_encoding='utf-8',
+                imports=[IMPORT % ', '.join(identifiers)],
+            )
+    tpt = _templates[path]
     return tpt.render(**variables) if variables else tpt.render()
 
+def _stable(obj):
+    '''
+    Return JSON-serialisable version of object for hashing
+    '''
+
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    else:
+        return repr(obj)
+
+def _renderkey(path, variables):
+    '''
+    Return key identifying template rendering
+    '''
+
+    # Templates import manifest functions, which may change between runs
+    if 'imports' not in _renderscache:
+        imports = hashlib.sha1(' '.join(sorted(__muppet__)))
+        try:
+            with open(__file__.rstrip('co')) as fhl:
+                imports.update(fhl.read())
+        except IOError:
+            pass
+        _renderscache['imports'] = imports.hexdigest()
+
+    digest = hashlib.sha1(_renderscache['imports'])
+    digest.update(__muppet__.get('_root', ''))
+    with open(path) as fhl:
+        digest.update(fhl.read())
+    try:
+        digest.update(json.dumps(variables, sort_keys=True, default=_stable))
+    except TypeError: # E.g. non-string keys
+        digest.update(repr(sorted(variables.items())))
+
+    return digest.hexdigest()
+
+def _renderdir():
+    '''
+    Return directory of rendered templates kept across runs, pruned of the
+    least recently used ones
+    '''
+
+    directory = '%s/cache/render' % __muppet__['_directory']
+    with _renderslock:
+        if 'pruned' not in _renderscache:
+            _renderscache['pruned'] = True
+            try:
+                paths = ['%s/%s' % (directory, key)
+                         for key in os.listdir(directory)]
+                paths.sort(key=os.path.getmtime, reverse=True)
+                for path in paths[RENDERCACHE:]:
+                    os.remove(path)
+            except OSError, exc:
+                if exc.errno != errno.ENOENT:
+                    logging.warning(exc)
+
+    return directory
+
+def _render(path, variables):
+    '''
+    Apply template unless it was already with the same variables
+    '''
+
+    key = _renderkey(path, variables)
+
+    # Was it rendered during this run?
+    with _renderslock:
+        if key in _renders:
+            contents = _renders[key] = _renders.pop(key)
+            return contents
+
+    # Was it rendered during a previous run?
+    contents = None
+    if __muppet__.get('_cache'):
+        cachepath = '%s/%s' % (_renderdir(), key)
+        try:
+            with open(cachepath) as fhl:
+                contents = fhl.read().decode('utf-8')
+            os.utime(cachepath, None)
+        except IOError:
+            pass
+
+    if contents is None:
+        contents = _template(path, variables)
+
+        if __muppet__.get('_cache'):
+            try:
+                if not os.path.isdir(os.path.dirname(cachepath)):
+                    os.makedirs(os.path.dirname(cachepath))
+                tmppath = '%s.%d.%s' % (cachepath, os.getpid(),
+                                        threading.current_thread().ident)
+                with open(tmppath, 'w') as fhl:
+                    fhl.write(contents.encode('utf-8'))
+                os.rename(tmppath, cachepath)
+            except (IOError, OSError), exc:
+                logging.warning(exc)
+
+    with _renderslock:
+        _renders[key] = contents
+        while len(_renders) > RENDERCACHE:
+            _renders.popitem(last=False)
+
+    return contents
+
 def _backup(path):
     '''
     Backup config file
     '''
 
-    components = expanduser(path).split('/')
+    components = path.split('/')
 
     # Create backup directory
     now = __muppet__['_time'].strftime(TIMEFMT)
     backupdir = '%s/backups/%s' % (__muppet__['_directory'], now)
     if not os.path.exists(backupdir) and not __muppet__['_dryrun']:
-        os.makedirs(backupdir)
+        try:
+            os.makedirs(backupdir)
+        except OSError, exc: # Other roots may be backing up at the same time
+            if exc.errno != errno.EEXIST:
+                raise
 
     # Create local directories if needs be
     for i, _ in enumerate(components[1:-1], 2):
         localdir = '%s/%s' % (backupdir, '/'.join(components[1:i]))
         if not os.path.exists(localdir) and not __muppet__['_dryrun']:
-            os.mkdir(localdir)
+            try:
+                os.mkdir(localdir)
+            except OSError, exc:
+                if exc.errno != errno.EEXIST:
+                    raise
 
     # Write file backups
     logging.info("backing up %s to %s", path, localdir)
@@ -617,13 +1577,14 @@ def _backup(path):
         if not __muppet__['_dryrun']:
             # Will dereference before copying
             try:
-                shutil.copy2(expanduser(path), localpath)
+                shutil.copy2(path, localpath)
             except IOError, exc:
                 logging.warning(exc)
                 return False
 
-            status = os.stat(expanduser(path))
+            status = os.stat(path)
             os.chown(localpath, status.st_uid, status.st_gid)
+            _count('backupbytes', value=status.st_size)
 
     # Fix directory stats
     for i, _ in enumerate(components[1:-1], 2):
@@ -643,14 +1604,14 @@ def _edit(srcpath, path, contents):
 
     logging.info("editing %s", path)
     if not __muppet__['_dryrun']:
-        configfile = open(expanduser(path), 'w')
+        configfile = open(path, 'w')
         configfile.write(contents)
         configfile.close()
 
     logging.info("copying stat to %s", path)
     if not __muppet__['_dryrun']:
         # Will dereference before copying stat
-        shutil.copystat(srcpath, expanduser(path))
+        shutil.copystat(srcpath, path)
 
 def _contents(srcpath, variables):
     '''
@@ -660,7 +1621,7 @@ def _contents(srcpath, variables):
     if variables:
         # TODO Gracefully skip applying template when Mako is missing,
         # and suggest it be installed
-        contents = _template(srcpath, variables)
+        contents = _render(srcpath, variables)
     else:
         configfile = open(srcpath)
         contents = configfile.read()
@@ -668,27 +1629,31 @@ def _contents(srcpath, variables):
 
     return contents
 
+@_resource
 def mkdir(path, owner, group, mode):
     '''
     Make directory and set attributes
     '''
 
     change = False
+    path = _path(path)
 
     try:
         # Make directory
-        if not os.path.lexists(expanduser(path)):
+        snapshot = _Snapshot(path)
+        if not snapshot.exists:
             logging.info("making directory %s", path)
             if not __muppet__['_dryrun']:
-                os.mkdir(expanduser(path))
+                os.mkdir(path)
+                snapshot = _Snapshot(path)
             change |= True
 
-        if isdir(expanduser(path)):
+        if snapshot.isdir:
             # Change ownership
-            change |= _chown(path, os.stat(expanduser(path)), owner, group)
+            change |= _chown(snapshot, owner, group)
 
             # Change mode
-            change |= chmod(path, mode)
+            change |= _chmod(snapshot, mode)
         elif not __muppet__['_dryrun']:
             logging.warn("%s isn't a directory - aborting", path)
     except OSError, exc:
@@ -697,26 +1662,29 @@ def mkdir(path, owner, group, mode):
     return change
 
 
+@_resource
 def symlink(source, name, owner, group):
     '''
     Make symbolic link
     '''
 
     change = False
+    name = _path(name)
 
     try:
         # Create link
-        if not os.path.lexists(expanduser(name)):
+        snapshot = _Snapshot(name)
+        if not snapshot.exists:
             logging.info("symlinking %s to %s", source, name)
             if not __muppet__['_dryrun']:
-                # Make link
-                os.symlink(expanduser(source), expanduser(name))
+                # Make link, which must resolve from within the alternate root
+                os.symlink(_expand(source), name)
+                snapshot = _Snapshot(name)
             change |= True
 
         # Change ownership
-        if islink(expanduser(name)):
-            change |= _chown(expanduser(name), os.lstat(expanduser(name)),
-                             owner, group, True)
+        if snapshot.islink:
+            change |= _chown(snapshot, owner, group, True)
         elif not __muppet__['_dryrun']:
             logging.warn("%s isn't a link - aborting", name)
     except OSError, exc:
@@ -724,30 +1692,196 @@ def symlink(source, name, owner, group):
 
     return change
 
+@_resource
 def mv(src, dst):
     '''
     Move file
     '''
 
-    if os.path.lexists(expanduser(dst)):
+    src, dst = _path(src), _path(dst)
+
+    if os.path.lexists(dst):
         logging.warn("won't move %s to %s, file already exists", src, dst)
     else:
         logging.info("moving %s to %s", src, dst)
         if not __muppet__['_dryrun']:
-            shutil.move(expanduser(src), expanduser(dst))
+            shutil.move(src, dst)
 
         return True
 
+@_resource
 def rmtree(path):
     '''
     Recursively remove files
     '''
 
+    path = _path(path)
+
     logging.info("recursively removing %s", path)
     if not __muppet__['_dryrun']:
-        shutil.rmtree(expanduser(path))
+        shutil.rmtree(path)
     return True
 
+def _scan(path, missing=False):
+    '''
+    Return directory entries mapped to their lstat, none if the directory
+    may be missing and is
+    '''
+
+    try:
+        if scandir:
+            return dict((entry.name, entry.stat(follow_symlinks=False))
+                        for entry in scandir(path))
+        else:
+            return dict((name, os.lstat('%s/%s' % (path, name)))
+                        for name in os.listdir(path))
+    except OSError, exc:
+        if missing and exc.errno == errno.ENOENT:
+            return {}
+        raise
+
+def _syncattrs(path, status, owner, group, uid, gid, mode):
+    '''
+    Change owner and mode of synchronised file or directory, unconditionally
+    if it was just written
+    '''
+
+    change = False
+
+    if status is None and __muppet__['_dryrun']:
+        return change
+
+    if status is None or uid != status.st_uid or gid != status.st_gid:
+        logging.info("chowning %s:%s %s", owner, group, path)
+        if not __muppet__['_dryrun']:
+            os.chown(path, uid, gid)
+        change = True
+
+    if status is None or mode != stat.S_IMODE(status.st_mode):
+        logging.info("chmoding %s %s", oct(mode), path)
+        if not __muppet__['_dryrun']:
+            os.chmod(path, mode)
+        change = True
+
+    return change
+
+@_resource
+def sync(srcdir, destdir, owner, group, mode, dirmode=None, delete=False):
+    '''
+    Synchronise directory tree
+    '''
+
+    change = False
+
+    srcdir = '%s/files/%s' % (__muppet__['_directory'], srcdir.rstrip('/'))
+    destdir = _path(destdir).rstrip('/')
+
+    # Resolve attributes once and for all
+    uid = _uid(owner)
+    gid = _gid(group)
+    filemode = _mode(mode)
+    if filemode is None:
+        logging.warning("invalid %s mode - aborting sync", mode)
+        return False
+    if dirmode:
+        dirmodestr, dirmode = dirmode, _mode(dirmode)
+        if dirmode is None:
+            logging.warning("invalid %s mode - aborting sync", dirmodestr)
+            return False
+    else:
+        # Directories can be searched wherever they can be read
+        dirmode = filemode | (filemode & 0444) >> 2
+
+    # Don't empty the destination for want of a source
+    if not os.path.isdir(srcdir):
+        logging.warning("%s isn't a directory - aborting sync", srcdir)
+        return False
+
+    try:
+        # Make top directory if needs be
+        try:
+            status = os.lstat(destdir)
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            logging.info("making directory %s", destdir)
+            if not __muppet__['_dryrun']:
+                os.mkdir(destdir)
+            status = None
+            change = True
+        if status and not stat.S_ISDIR(status.st_mode):
+            logging.warn("%s isn't a directory - aborting", destdir)
+            return change
+        change |= _syncattrs(destdir, status, owner, group, uid, gid, dirmode)
+
+        # Compare each source directory with its destination in one pass
+        reldirs = ['']
+        while reldirs:
+            reldir = reldirs.pop()
+            srcentries = _scan(srcdir + reldir)
+            entries = _scan(destdir + reldir, True)
+
+            for name, srcstatus in sorted(srcentries.iteritems()):
+                srcpath = '%s%s/%s' % (srcdir, reldir, name)
+                path = '%s%s/%s' % (destdir, reldir, name)
+                status = entries.get(name)
+
+                if stat.S_ISDIR(srcstatus.st_mode):
+                    # Make directory if needs be
+                    if status is None:
+                        logging.info("making directory %s", path)
+                        if not __muppet__['_dryrun']:
+                            os.mkdir(path)
+                        change = True
+                    elif not stat.S_ISDIR(status.st_mode):
+                        logging.warn("%s isn't a directory - aborting", path)
+                        continue
+                    change |= _syncattrs(path, status, owner, group,
+                                         uid, gid, dirmode)
+                    reldirs.append('%s/%s' % (reldir, name))
+                elif stat.S_ISREG(srcstatus.st_mode):
+                    if status and stat.S_ISLNK(status.st_mode):
+                        logging.warning(WARNLINK, path)
+                        continue
+
+                    # Copy file if needs be, in which case its stats are
+                    # no longer relevant
+                    if status is None or \
+                        not stat.S_ISREG(status.st_mode) or \
+                        status.st_size != srcstatus.st_size or \
+                        (status.st_mtime != srcstatus.st_mtime and
+                         not filecmp.cmp(srcpath, path, False)):
+                        if status and not _backup(path):
+                            continue
+                        logging.info("copying %s to %s", srcpath, path)
+                        if not __muppet__['_dryrun']:
+                            shutil.copy2(srcpath, path)
+                        status = None
+                        change = True
+                    change |= _syncattrs(path, status, owner, group,
+                                         uid, gid, filemode)
+                else:
+                    logging.warning("won't sync special file %s", srcpath)
+
+            # Remove extraneous files if needs be
+            if delete:
+                for name in sorted(set(entries) - set(srcentries)):
+                    path = '%s%s/%s' % (destdir, reldir, name)
+                    if stat.S_ISDIR(entries[name].st_mode):
+                        logging.info("recursively removing %s", path)
+                        if not __muppet__['_dryrun']:
+                            shutil.rmtree(path)
+                    else:
+                        logging.info("removing %s", path)
+                        if not __muppet__['_dryrun']:
+                            os.remove(path)
+                    change = True
+    except (IOError, OSError), exc:
+        logging.warning(exc)
+
+    return change
+
+@_resource
 def edit(srcpath, path, owner, group, mode, variables=None):
     '''
     Edit config file with template
@@ -756,14 +1890,16 @@ def edit(srcpath, path, owner, group, mode, variables=None):
     change = False
 
     srcpath = '%s/files/%s' % (__muppet__['_directory'], srcpath)
-
-    if islink(expanduser(path)):
-        # If our config file template maps to a symlink, we're on for a lot of
-        # confusion, so let's not allow this
-        logging.warning(WARNLINK, path)
-        return False
+    path = _path(path)
 
     try:
+        snapshot = _Snapshot(path)
+        if snapshot.islink:
+            # If our config file template maps to a symlink, we're on for a
+            # lot of confusion, so let's not allow this
+            logging.warning(WARNLINK, path)
+            return False
+
         # Compile config file contents
         contents = _contents(srcpath, variables)
 
@@ -772,23 +1908,23 @@ def edit(srcpath, path, owner, group, mode, variables=None):
 
         if diff:
             # Back up config file
-            if os.path.exists(expanduser(path)) and not _backup(path):
+            if snapshot.exists and not _backup(path):
                 return False
 
-            # Edit config file
+            # Edit config file, after which its status changed
             _edit(srcpath, path, contents)
+            if not __muppet__['_dryrun']:
+                snapshot = _Snapshot(path)
             change = True
 
         # Change attributes
-        if os.path.exists(expanduser(path)):
-            status = os.stat(expanduser(path))
-
+        if snapshot.exists:
             # Change owner and group
-            change |= _chown(path, status, owner, group)
+            change |= _chown(snapshot, owner, group)
 
             # Change mode
-            change |= chmod(path, mode)
-    except IOError, exc:
+            change |= _chmod(snapshot, mode)
+    except (IOError, OSError), exc:
         logging.warning(exc)
         return False
 
@@ -799,15 +1935,24 @@ def isjustinstalled():
     Check if OS was freshly installed
     '''
 
-    return not os.path.exists(__muppet__['_directory'] + '/notjustinstalled')
+    return not os.path.exists(_path(__muppet__['_directory'] +
+                                    '/notjustinstalled'))
 
+@_resource
 def notjustinstalled():
     '''
     Mark system as not just installed
     '''
 
+    path = _path(__muppet__['_directory'] + '/notjustinstalled')
+    if os.path.exists(path):
+        return False
+
     if not __muppet__['_dryrun']:
-        open(__muppet__['_directory'] + '/notjustinstalled', 'w').close()
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+    return True
 
 def islaptop():
     '''
@@ -816,6 +1961,7 @@ def islaptop():
 
     return len(os.listdir('/sys/class/power_supply'))
 
+@_resource
 def visudo(srcpath, filename, variables=None):
     '''
     Edit sudoers
@@ -823,9 +1969,15 @@ def visudo(srcpath, filename, variables=None):
 
     change = False
 
-    path = '%s/%s' % (SUDOERSD, filename)
+    path = _path('%s/%s' % (SUDOERSD, filename))
     srcpath = '%s/files/%s' % (__muppet__['_directory'], srcpath)
 
+    # Links in sudoers.d are as confusing as in edit(), and dangling ones
+    # can't have their attributes changed
+    if _Snapshot(path).islink:
+        logging.warning(WARNLINK, path)
+        return False
+
     # Compile config file contents
     contents = _contents(srcpath, variables)
 
@@ -865,14 +2017,13 @@ def visudo(srcpath, filename, variables=None):
                 logging.warning("%s busy - aborting edit", path)
 
     # Change attributes
-    if os.path.exists(path):
-        status = os.stat(path)
-
+    snapshot = _Snapshot(path)
+    if snapshot.exists:
         # Change owner and group
-        change |= _chown(path, status, 'root', 'root')
+        change |= _chown(snapshot, 'root', 'root')
 
         # Change mode
-        change |= chmod(path, '-r--r-----')
+        change |= _chmod(snapshot, '-r--r-----')
 
     return change
 
@@ -881,14 +2032,20 @@ def hostname():
     Return host name
     '''
 
-    return socket.gethostname()
+    # An alternate root is named after its own /etc/hostname
+    path = _path('/etc/hostname')
+    if __muppet__.get('_root') and os.path.exists(path):
+        with open(path) as fhl:
+            return fhl.read().strip()
+    else:
+        return socket.gethostname()
 
 def architecture():
     '''
     Return architecture from dpkg
     '''
 
-    proc = Popen(['/usr/bin/dpkg', '--print-architecture'], stdout=PIPE)
+    proc = Popen(_dpkg('--print-architecture'), stdout=PIPE)
     out, _ = proc.communicate()
     return out.strip()
 
@@ -898,7 +2055,8 @@ def release():
     '''
 
     devnull = open(os.devnull, 'w')
-    proc = Popen(['/usr/bin/lsb_release', '-rs'], stdout=PIPE, stderr=devnull)
+    proc = Popen(_chroot('/usr/bin/lsb_release', '-rs'),
+                 stdout=PIPE, stderr=devnull)
     out, _, = proc.communicate()
     devnull.close()
     return out.strip()
@@ -917,11 +2075,13 @@ __muppet__ = {
     'symlink':            symlink,
     'mv':                 mv,
     'rmtree':             rmtree,
+    'sync':               sync,
     'chmod':              chmod,
     'resource':           resource,
 
     # Package management
     'install':            install,
+    'prefetch':           prefetch,
     'purge':              purge,
     'getselections':      getselections,
     'aptkey':             aptkey,
@@ -935,6 +2095,7 @@ __muppet__ = {
 
     # Flow control
     'include':            include,
+    'foreachuser':        foreachuser,
     'resolution':         resolution,
     'islaptop':           islaptop,
     'hostname':           hostname,